@@ -13,6 +13,10 @@ To configure the script, the following environment variables have to be set:
 PROXMOX_HOST        = FQDN of your Proxmox host
 PROXMOX_USER        = The user which is used to connect to the Proxmox API
 PROXMOX_PASSWORD    = The password for the user
+PROXMOX_TOKEN_NAME  = Name of an API token for the user
+                      Used instead of the password if set, which skips the
+                      ticket authentication round trip
+PROXMOX_TOKEN_VALUE = The secret of the API token
 PROXMOX_VERIFY_SSL  = True or false. Defaults to false if not set
 SSH_USER            = The user used to connect to the VMs
 SSH_KEY_FILE        = The path to the SSH key file used for authentication
@@ -23,29 +27,35 @@ TELEGRAM_BOT_TOKEN  = The authentication token of your Telegram bot
 TELEGRAM_CHAT_ID    = The channel identifier to send the message to
 POST_REQ_TIMEOUT    = Timeout for post requests. Defaults to 30 seconds
 ENABLE_PATCH_OUTPUT = Prints stdout of update command in pipeline
+MAX_CONCURRENCY     = How many VMs are patched at the same time. Defaults to 16
 DOMAIN              = Your domain
                       Is used as a fallback, if qemu-guest-agent can't get the hostname
 """
 
 
+import asyncio
+import concurrent.futures
+import functools
+import itertools
 import os
+import re
+import sys
 import time
-import paramiko
+import asyncssh
 import requests
-from proxmoxer import ProxmoxAPI
+from proxmoxer import ProxmoxAPI, ResourceException
+from requests.adapters import HTTPAdapter, Retry
+
+# Known string representations of a true value
+TRUE_VALUES = frozenset({"y", "yes", "t", "true", "on", "1"})
 
 # Proxmox configuration
 PROXMOX_HOST = os.getenv("PROXMOX_HOST")
 PROXMOX_USER = os.getenv("PROXMOX_USER")
 PROXMOX_PASSWORD = os.getenv("PROXMOX_PASSWORD")
-PROXMOX_VERIFY_SSL = os.getenv("PROXMOX_VERIFY_SSL", "false").lower() in (
-    "true",
-    "1",
-    "t",
-    "on",
-    "yes",
-    "y",
-)
+PROXMOX_TOKEN_NAME = os.getenv("PROXMOX_TOKEN_NAME")
+PROXMOX_TOKEN_VALUE = os.getenv("PROXMOX_TOKEN_VALUE")
+PROXMOX_VERIFY_SSL = os.getenv("PROXMOX_VERIFY_SSL", "false").lower() in TRUE_VALUES
 
 # SSH configuration
 SSH_USER = os.getenv("SSH_USER")
@@ -53,8 +63,16 @@ SSH_KEY_FILE = os.getenv("SSH_KEY_FILE")
 SSH_TIMEOUT = int(os.getenv("SSH_TIMEOUT", "300"))  # Default to 300 seconds
 SSH_RETRY_INTERVAL = int(os.getenv("SSH_RETRY_INTERVAL", "10"))  # Default to 10 seconds
 
+# Parse the SSH key once, so every connection reuses the loaded key
+SSH_KEY = asyncssh.read_private_key(SSH_KEY_FILE) if SSH_KEY_FILE else None
+
+# Limit of VMs patched at the same time, to avoid running into local
+# file descriptor limits or sshd connection limits
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "16"))  # Default to 16 VMs
+patch_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
 # Telegram Configuration
-ENABLE_NOTIFICATION = os.getenv("ENABLE_NOTIFICATION", "True")
+ENABLE_NOTIFICATION = os.getenv("ENABLE_NOTIFICATION", "True").lower() in TRUE_VALUES
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
@@ -62,19 +80,23 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 POST_REQ_TIMEOUT = int(os.getenv("POST_REQ_TIMEOUT", "30"))  # Default to 30 seconds
 
 # Trigger to enable patch output
-ENABLE_PATCH_OUTPUT = os.getenv("ENABLE_PATCH_OUTPUT", "False")
+ENABLE_PATCH_OUTPUT = os.getenv("ENABLE_PATCH_OUTPUT", "False").lower() in TRUE_VALUES
 
 # Domain
 DOMAIN = os.getenv("DOMAIN")
 
-# Connect to proxmox
-proxmox = ProxmoxAPI(
-    PROXMOX_HOST,
-    user=PROXMOX_USER,
-    password=PROXMOX_PASSWORD,
-    verify_ssl=PROXMOX_VERIFY_SSL,
+# HTTP session for notifications with connection pooling and retries
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+    ),
 )
-node = proxmox.nodes.get()[0]["node"]
 
 # Patchmanagement statistics
 stats = {
@@ -87,6 +109,18 @@ stats = {
     "unsupported": [],
 }
 
+# Cache for Proxmox API listings to avoid repeated round trips
+API_CACHE_TTL = 10  # seconds
+api_cache = {}
+
+# Matches the "X upgraded, Y newly installed, ..." summary line of apt-get
+DEBIAN_UPGRADED_RE = re.compile(r"^(\d+)\s+upgraded")
+
+# Markers used to smuggle the reboot check result and the detected
+# distro out of the fused update command
+REBOOT_MARKER = "__REBOOT__:"
+DISTRO_MARKER = "__DISTRO__:"
+
 
 class Style:
     """ANSI color codes for output styling"""
@@ -100,79 +134,156 @@ class Style:
     NC = "\033[0m"
 
 
+# Disable the ANSI styling when the output is not a terminal (e.g. when
+# piped into a CI log), unless FORCE_COLOR is set
+if not sys.stdout.isatty() and os.getenv("FORCE_COLOR") is None:
+    for color in ("RED", "GREEN", "BLUE", "YELLOW", "PURPLE", "CYAN", "NC"):
+        setattr(Style, color, "")
+
+
+# Sections of the result summary with their headers and output styling
+SUMMARY_SECTIONS = (
+    ("failed_patches", "Failed to patch the following VMs:", Style.RED),
+    ("ssh_failed_vms", "Failed to connect to the following VMs:", Style.RED),
+    (
+        "failed_snapshots",
+        "Failed to create snapshots for the following VMs:",
+        Style.RED,
+    ),
+    ("needs_reboot", "The following VMs have to be rebooted manually:", Style.RED),
+    (
+        "manual_patches",
+        "The following VMs are configured to be manually patched:",
+        Style.YELLOW,
+    ),
+    (
+        "unsupported",
+        "The following VMs are unsupported and could not be patched:",
+        Style.RED,
+    ),
+)
+
+
 def check_requirements():
-    """Checks if all requirements are satisfied"""
-    if convert_to_bool(ENABLE_NOTIFICATION):
-        return all(
-            v is not None
-            for v in [
-                DOMAIN,
-                PROXMOX_HOST,
-                PROXMOX_USER,
-                PROXMOX_PASSWORD,
-                SSH_USER,
-                SSH_KEY_FILE,
-                TELEGRAM_BOT_TOKEN,
-                TELEGRAM_CHAT_ID,
-            ]
+    """Checks if all required environment variables are set and aborts
+    with a clear message naming the missing ones
+    """
+    required = [
+        ("DOMAIN", DOMAIN),
+        ("PROXMOX_HOST", PROXMOX_HOST),
+        ("PROXMOX_USER", PROXMOX_USER),
+        ("SSH_USER", SSH_USER),
+        ("SSH_KEY_FILE", SSH_KEY_FILE),
+    ]
+    if not (PROXMOX_TOKEN_NAME and PROXMOX_TOKEN_VALUE):
+        required.append(("PROXMOX_PASSWORD", PROXMOX_PASSWORD))
+    if ENABLE_NOTIFICATION:
+        required.append(("TELEGRAM_BOT_TOKEN", TELEGRAM_BOT_TOKEN))
+        required.append(("TELEGRAM_CHAT_ID", TELEGRAM_CHAT_ID))
+    missing = [name for name, value in required if value is None]
+    if missing:
+        raise SystemExit(
+            f"{Style.RED}Missing environment variables:{Style.NC} {", ".join(missing)}"
         )
-    return all(
-        v is not None
-        for v in [
-            DOMAIN,
+
+
+def update_stats(stat, host, pkg=None):
+    """Updates a single statistic in the stats map.
+    A single append is atomic, so this is safe to call from the
+    parallel patch tasks.
+    """
+    stats[stat].append((host, pkg) if pkg is not None else host)
+
+
+@functools.cache
+def get_proxmox():
+    """Connects to the Proxmox API on first use.
+    An API token skips the ticket authentication round trip on every run
+    """
+    if PROXMOX_TOKEN_NAME and PROXMOX_TOKEN_VALUE:
+        return ProxmoxAPI(
             PROXMOX_HOST,
-            PROXMOX_USER,
-            PROXMOX_PASSWORD,
-            SSH_USER,
-            SSH_KEY_FILE,
-        ]
+            user=PROXMOX_USER,
+            token_name=PROXMOX_TOKEN_NAME,
+            token_value=PROXMOX_TOKEN_VALUE,
+            verify_ssl=PROXMOX_VERIFY_SSL,
+        )
+    return ProxmoxAPI(
+        PROXMOX_HOST,
+        user=PROXMOX_USER,
+        password=PROXMOX_PASSWORD,
+        verify_ssl=PROXMOX_VERIFY_SSL,
     )
 
 
-def convert_to_bool(value):
-    """Convers a given value to a boolean based on known boolean representations"""
-    value = value.lower()
-    return value in ("y", "yes", "t", "true", "on", "1")
+@functools.cache
+def get_node():
+    """Resolves the name of the first Proxmox node on first use"""
+    return get_proxmox().nodes.get()[0]["node"]
 
 
-def update_stats(stat, host, pkg=None):
-    """Updates a single statistic in the stats map"""
-    data = stats[stat]
-    if pkg is not None:
-        data.append((host, pkg))
-    else:
-        data.append(host)
-    stats[stat] = data
+@functools.lru_cache(maxsize=256)
+def vm_api(vmid):
+    """Returns the Proxmox API path of a VM, cached per VM ID"""
+    return get_proxmox().nodes(get_node()).qemu(vmid)
+
+
+def cached_api_get(key, getter):
+    """Returns a cached Proxmox API listing if it is still fresh,
+    otherwise fetches it again and refreshes the cache
+    """
+    entry = api_cache.get(key)
+    if entry is not None and time.time() - entry[0] < API_CACHE_TTL:
+        return entry[1]
+    data = getter()
+    api_cache[key] = (time.time(), data)
+    return data
+
+
+def get_qemu_list():
+    """Gets the list of all VMs on the node, cached for a few seconds"""
+    return cached_api_get("qemu", get_proxmox().nodes(get_node()).qemu.get)
+
+
+def get_snapshots(vmid):
+    """Gets the snapshot list of a VM, cached for a few seconds"""
+    return cached_api_get(("snapshot", vmid), vm_api(vmid).snapshot.get)
 
 
 def start_vm(vmid):
     """Starts a VM via the proxmox API"""
     print(f"Starting VM: {Style.BLUE}{vmid}{Style.NC}")
-    proxmox.nodes(node).qemu(vmid).status().start.post(timeout=POST_REQ_TIMEOUT)
+    vm_api(vmid).status().start.post(timeout=POST_REQ_TIMEOUT)
 
 
 def stop_vm(vmid):
     """Stops a VM via the proxmox API"""
     print(f"Stopping VM: {Style.BLUE}{vmid}{Style.NC}")
-    proxmox.nodes(node).qemu(vmid).status().shutdown.post(timeout=POST_REQ_TIMEOUT)
+    vm_api(vmid).status().shutdown.post(timeout=POST_REQ_TIMEOUT)
 
 
 def reboot_vm(vmid):
     """Reboots a VM via the proxmox API"""
-    proxmox.nodes(node).qemu(vmid).status().reboot.post(timeout=POST_REQ_TIMEOUT)
+    vm_api(vmid).status().reboot.post(timeout=POST_REQ_TIMEOUT)
 
 
 def get_hostname(vm):
-    """Gets the hostname for a VM.
-    Falls back to VM name and domain if no guest agent is enabled
+    """Gets the hostname for a VM by asking the guest agent directly.
+    Falls back to VM name and domain if no guest agent is available
+    or the guest agent does not answer
     """
-    config = proxmox.nodes(node).qemu(vm["vmid"]).config.get()
-    if config["agent"] == 1:
-        data = proxmox.nodes(node).qemu(vm["vmid"]).agent.get("get-host-name")
-        host = data["result"]["host-name"]
-    else:
-        host = f"{vm["name"]}.{DOMAIN}"
-    return host
+    try:
+        data = vm_api(vm["vmid"]).agent.get("get-host-name")
+        return data["result"]["host-name"]
+    except ResourceException:
+        # The VM has no guest agent, the fallback is expected
+        pass
+    except Exception as e:
+        print(
+            f"{Style.YELLOW}Could not get the hostname of VM "
+            f"{Style.BLUE}{vm["vmid"]}{Style.YELLOW} via the guest agent: {e}{Style.NC}"
+        )
+    return f"{vm["name"]}.{DOMAIN}"
 
 
 def get_vms():
@@ -180,176 +291,224 @@ def get_vms():
     Patching and rebooting is controlled via the tags.
     If a predefined reboot and patch tag are found, the values in the map are set accordingly.
     """
-    all_vms = proxmox.nodes(node).qemu.get()
-    vms = {}
+    all_vms = get_qemu_list()
+    candidates = []
     for vm in all_vms:
         if vm.get("template", 0) == 1:
             continue
-        if "patch" not in vm.get("tags", []).split(";"):
+        tags = set((vm.get("tags") or "").split(";"))
+        if "patch" not in tags:
             update_stats("manual_patches", f"{vm["name"]}.{DOMAIN}")
             continue
-        hostname = get_hostname(vm)
-        reboot = False
-        if "reboot" in vm.get("tags", []).split(";"):
-            reboot = True
+        candidates.append((vm, tags))
+    vms = {}
+    if not candidates:
+        return vms
+    # The hostname lookups are independent API round trips, so they run
+    # in parallel instead of one VM after another
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(16, len(candidates))
+    ) as executor:
+        hostnames = list(executor.map(get_hostname, [vm for vm, tags in candidates]))
+    for (vm, tags), hostname in zip(candidates, hostnames):
+        distro = None
+        if "redhat" in tags:
+            distro = "redhat"
+        elif "debian" in tags:
+            distro = "debian"
         vms[vm["vmid"]] = {
             "hostname": hostname,
             "status": vm["status"],
-            "reboot": reboot,
+            "reboot": "reboot" in tags,
+            "distro": distro,
         }
     return vms
 
 
-def ssh_command(host, command):
-    """Executes a given command on a host via SSH"""
-    print(f"Connecting to Host: {Style.BLUE}{host}{Style.NC}")
-    print(f"Executing command: {Style.PURPLE}{command}{Style.NC}")
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=host, username=SSH_USER, key_filename=SSH_KEY_FILE)
-    stdin, stdout, stderr = ssh.exec_command(command)
-    exit_status = stdout.channel.recv_exit_status()
-    ssh.close()
-    return exit_status, stdout.read().decode(), stderr.read().decode()
+async def stream_lines(stream, host):
+    """Yields the output of an SSH stream line by line.
+    Prints the lines while they arrive if ENABLE_PATCH_OUTPUT is set.
+    """
+    async for line in stream:
+        line = line.rstrip("\n")
+        if ENABLE_PATCH_OUTPUT:
+            print(f"{Style.BLUE}{host}:{Style.NC} {line}")
+        yield line
 
 
-def ssh_available(host):
-    """Checks if SSH is available for a given host"""
-    start_time = time.time()
+async def extract_markers(lines, result):
+    """Filters the marker lines out of a command output stream
+    and stores their values in the given result map
+    """
+    async for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith(REBOOT_MARKER):
+            result["reboot_required"] = line.removeprefix(REBOOT_MARKER) == "1"
+            continue
+        if line.startswith(DISTRO_MARKER):
+            result["distro"] = line.removeprefix(DISTRO_MARKER)
+            continue
+        yield line
+
+
+async def wait_and_connect(host):
+    """Waits until SSH is available for a given host and returns the
+    open connection, so all following commands can reuse it.
+    Returns None if the host is not reachable within SSH_TIMEOUT.
+    """
+    start_time = time.monotonic()
     total_attempts = SSH_TIMEOUT // SSH_RETRY_INTERVAL
-    attempt = 0
-    while time.time() - start_time < SSH_TIMEOUT:
-        attempt = attempt + 1
+    warn_threshold = total_attempts // 2
+    alert_threshold = total_attempts // 5 * 4
+    attempt_prefix = f"Attempting connection to {Style.BLUE}{host}{Style.NC}."
+    for attempt in itertools.count(1):
+        if time.monotonic() - start_time >= SSH_TIMEOUT:
+            break
         try:
-            if total_attempts // 5 * 4 < attempt:
+            if attempt > alert_threshold:
                 style = Style.RED
-            elif total_attempts // 2 < attempt:
+            elif attempt > warn_threshold:
                 style = Style.YELLOW
             else:
                 style = Style.GREEN
             print(
-                f"Attempting connection to {Style.BLUE}{host}{Style.NC}. "
-                f"{style}{attempt}/{total_attempts} attempts.{Style.NC}"
+                f"{attempt_prefix} {style}{attempt}/{total_attempts} attempts.{Style.NC}"
             )
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(hostname=host, username=SSH_USER, key_filename=SSH_KEY_FILE)
-            ssh.close()
-            return True
-        except (
-            paramiko.ssh_exception.NoValidConnectionsError,
-            paramiko.ssh_exception.SSHException,
-        ):
+            return await asyncssh.connect(
+                host,
+                username=SSH_USER,
+                client_keys=[SSH_KEY],
+                agent_path=None,
+                known_hosts=None,
+                keepalive_interval=30,
+            )
+        except (OSError, asyncssh.Error):
             print(
                 f"{Style.YELLOW}Connection attempt to {Style.BLUE}{host}{Style.YELLOW} failed."
                 f"{Style.NC} Waiting {SSH_RETRY_INTERVAL} seconds to retry."
             )
-            time.sleep(SSH_RETRY_INTERVAL)
-    return False
+            await asyncio.sleep(SSH_RETRY_INTERVAL)
+    return None
 
 
-def set_update_command(host):
-    """Detects the package manager to use and sets the according update command"""
-    command = "which dnf"
-    exit_status, stdout, stderr = ssh_command(host, command)
-    if stdout:
-        lines = stdout.splitlines()
-        if lines[0].startswith("/") and lines[0].endswith("dnf"):
-            print(
-                f"{Style.GREEN}Red Hat based distro detected.{Style.NC} "
-                f"Setting package manager to {Style.PURPLE}{lines[0]}{Style.NC}"
-            )
-            distro = "redhat"
-            package_manager = lines[0]
-            update_command = "update -y"
-            return distro, package_manager, update_command
-    command = "which apt-get"
-    exit_status, stdout, stderr = ssh_command(host, command)
-    if stdout:
-        lines = stdout.splitlines()
-        if lines[0].startswith("/") and lines[0].endswith("apt-get"):
-            print(
-                f"{Style.GREEN}Debian based distro detected.{Style.NC} "
-                f"Setting package manager to {Style.PURPLE}{lines[0]}{Style.NC}"
-            )
-            distro = "debian"
-            package_manager = lines[0]
-            update_command = "upgrade -y"
-            return distro, package_manager, update_command
-    print(
-        f"{Style.RED}Unsupported distro detected! "
-        f"Could not set package manager!{Style.NC}"
+def build_patch_command(distro):
+    """Builds the fused update command for a VM.
+    Database refresh, upgrade and the reboot check run in a single SSH
+    exec. If the distro is not known from a tag, the detection also
+    happens on the remote side and is reported back via a marker line.
+    """
+    redhat_patch = (
+        "sudo dnf update -y; rc=$?; "
+        "sudo needs-restarting -r > /dev/null 2>&1; "
+        f"[ $? -eq 1 ] && echo {REBOOT_MARKER}1 || echo {REBOOT_MARKER}0"
+    )
+    debian_patch = (
+        "sudo apt-get update -y && sudo apt-get upgrade -y; rc=$?; "
+        "[ -f /var/run/reboot-required ] "
+        f"&& echo {REBOOT_MARKER}1 || echo {REBOOT_MARKER}0"
+    )
+    if distro == "redhat":
+        return f"{redhat_patch}; exit $rc"
+    if distro == "debian":
+        return f"{debian_patch}; exit $rc"
+    return (
+        f"if command -v dnf > /dev/null; then echo {DISTRO_MARKER}redhat; "
+        f"{redhat_patch}; "
+        f"elif command -v apt-get > /dev/null; then echo {DISTRO_MARKER}debian; "
+        f"{debian_patch}; "
+        f"else echo {DISTRO_MARKER}unsupported; rc=1; fi; exit $rc"
     )
-    return None, None, None
 
 
-def count_updated_packages(output, distro):
-    """Counts the amount of packages which were updated"""
-    lines = output.splitlines()
-    if distro == "redhat":
-        in_upgrade_section = False
-        updated_packages = 0
-        for line in lines:
-            if line.startswith("Upgraded:"):
-                in_upgrade_section = True
-            elif (
-                in_upgrade_section
-                and line.startswith("Installed:")
-                or line.strip() == ""
-            ):
-                continue
-            elif in_upgrade_section and (
-                line.startswith("Removed:") or line.startswith("Complete!")
-            ):
-                break
-            elif in_upgrade_section:
-                updated_packages += 1
-    elif distro == "debian":
-        updated_packages = 0
-        for line in lines:
-            if "upgraded" not in line:
+async def count_updated_packages(lines):
+    """Counts the amount of packages which were updated.
+    Handles both the dnf Upgraded section and the apt-get summary line,
+    so the distro does not have to be known in advance.
+    Consumes the output line by line, so large update logs never have to
+    be held in memory at once. The stream is always drained completely
+    to keep the remote command from blocking on a full output buffer.
+    """
+    dnf_count = 0
+    apt_count = None
+    in_upgrade_section = False
+    dnf_done = False
+    async for line in lines:
+        if apt_count is None:
+            match = DEBIAN_UPGRADED_RE.match(line)
+            if match:
+                apt_count = int(match.group(1))
                 continue
-            updated_packages = line.split(" ", 1)[0]
-    return updated_packages
+        if dnf_done:
+            continue
+        if line.startswith("Upgraded:"):
+            in_upgrade_section = True
+        elif not in_upgrade_section:
+            continue
+        elif line.startswith("Installed:") or not line.strip():
+            continue
+        elif line.startswith("Removed:") or line.startswith("Complete!"):
+            dnf_done = True
+        else:
+            dnf_count += 1
+    return apt_count if apt_count is not None else dnf_count
 
 
 def send_telegram_message(message):
     """Function to send a Telegram notification."""
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     data = {"chat_id": TELEGRAM_CHAT_ID, "text": message, "parse_mode": "HTML"}
-    response = requests.post(url, data=data, timeout=POST_REQ_TIMEOUT)
+    response = session.post(url, data=data, timeout=POST_REQ_TIMEOUT)
     if response.status_code != 200:
         print(
             f"{Style.RED}Failed to send message:{Style.NC} {response.status_code}, {response.text}"
         )
 
 
-def delete_latest_snapshot(vmid):
+async def wait_for_task(upid):
+    """Waits for a Proxmox task to finish by polling its status with
+    exponential backoff. Returns the exit status of the task.
+    """
+    delay = 0.2
+    while True:
+        task = await asyncio.to_thread(get_proxmox().nodes(get_node()).tasks(upid).status.get)
+        if task["status"] == "stopped":
+            return task.get("exitstatus")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 2)
+
+
+async def delete_latest_snapshot(vmid):
     """Function to get and delete the latest snapshot"""
-    snapshots = proxmox.nodes(node).qemu(vmid).snapshot.get()
+    snapshots = await asyncio.to_thread(get_snapshots, vmid)
     if snapshots and len(snapshots) > 1:
         latest_snapshot = snapshots[-2]["name"]
         print(
             f"Snapshot {Style.CYAN}{latest_snapshot}{Style.NC} found. Deleting snapshot..."
         )
-        proxmox.nodes(node).qemu(vmid).snapshot(latest_snapshot).delete()
-        time.sleep(5)
+        upid = await asyncio.to_thread(vm_api(vmid).snapshot(latest_snapshot).delete)
+        api_cache.pop(("snapshot", vmid), None)
+        await wait_for_task(upid)
     else:
         print("No snapshot found. Continue as normal...")
 
 
-def create_snapshot(vmid):
-    """Function to create a snapshot"""
-    snapshot_name = f"snapshot-{str(time.time_ns())}"
+async def create_snapshot(vmid):
+    """Function to create a snapshot.
+    Returns the snapshot name and whether the creation task succeeded.
+    """
+    snapshot_name = f"pm-{int(time.time()):x}"
     print(f"Creating new snapshot: {Style.CYAN}{snapshot_name}{Style.NC}")
-    proxmox.nodes(node).qemu(vmid).snapshot.post(snapname=snapshot_name)
-    time.sleep(5)
-    return snapshot_name
+    upid = await asyncio.to_thread(
+        vm_api(vmid).snapshot.post, snapname=snapshot_name
+    )
+    api_cache.pop(("snapshot", vmid), None)
+    exitstatus = await wait_for_task(upid)
+    return snapshot_name, exitstatus == "OK"
 
 
 def verify_snapshot(vmid, host, snapshot_name):
     """Function to verify the existance of a snapshot"""
-    existing_snapshots = proxmox.nodes(node).qemu(vmid).snapshot.get()
+    existing_snapshots = get_snapshots(vmid)
     if any(snapshot["name"] == snapshot_name for snapshot in existing_snapshots):
         return True
     print(
@@ -360,14 +519,16 @@ def verify_snapshot(vmid, host, snapshot_name):
     return False
 
 
-def manage_snapshots(vmid, host):
+async def manage_snapshots(vmid, host):
     """Function to manage snapshots.
     This will delete the latest snapsot, create a new one and verify it
     """
-    delete_latest_snapshot(vmid)
+    await delete_latest_snapshot(vmid)
     try:
-        snapshot_name = create_snapshot(vmid)
-        return verify_snapshot(vmid, host, snapshot_name)
+        snapshot_name, created = await create_snapshot(vmid)
+        if created:
+            return True
+        return await asyncio.to_thread(verify_snapshot, vmid, host, snapshot_name)
     except Exception as e:
         print(
             f"{Style.RED}Snapshot creation failed for {Style.BLUE}{host}{Style.NC}: {e}"
@@ -376,144 +537,113 @@ def manage_snapshots(vmid, host):
     return False
 
 
-def message_section(header, style, content):
-    """Function to generate a message section"""
-    section_lines = []
-    section_lines.append(header)
+def format_section(header, content):
+    """Builds the plain text lines of a message section"""
+    section_lines = [header]
+    section_lines.extend(content)
+    return section_lines
+
+
+def print_section(header, style, content):
+    """Prints a message section with ANSI styling"""
     print(f"\n\n{style}{header}{Style.NC}\n")
     for item in content:
-        section_lines.append(item)
         print(f"{Style.BLUE}{item}{Style.NC}")
-    return section_lines
 
 
-def result_header(failed_vms, failed_snapshots, failed_patches):
+def result_header(statistics):
     """Function to determine the header of the result output"""
-    if failed_vms or failed_snapshots or failed_patches:
-        header = "Patchmanagement completed with errors\n"
-        print(f"\n\n{Style.RED}Patchmanagement completed with errors{Style.NC}\n")
-    else:
-        header = "Patchmanagement completed successfully\n"
-        print(f"\n\n{Style.GREEN}Patchmanagement completed successfully{Style.NC}\n")
-    return header
-
-
-def patched_vms(vms):
-    """Part of the result output section"""
-    section_lines = []
-    section_lines.append("The following VMs have been patched:")
-    print("\n\nThe following VMs have been patched:\n")
+    if (
+        statistics["ssh_failed_vms"]
+        or statistics["failed_snapshots"]
+        or statistics["failed_patches"]
+    ):
+        return "Patchmanagement completed with errors\n"
+    return "Patchmanagement completed successfully\n"
+
+
+def format_patched_vms(vms):
+    """Builds the plain text lines of the patched VMs section"""
+    section_lines = ["The following VMs have been patched:"]
     for host, updated_packages in vms:
         section_lines.append(f"{host}: {updated_packages} packages updated")
-        print(f"{Style.BLUE}{host}:{Style.NC} {updated_packages} packages updated")
     return section_lines
 
 
 def generate_notification(statistics):
-    """Generate a notification message."""
-    message_lines = []
-    message_lines.append(
-        result_header(
-            statistics["ssh_failed_vms"],
-            statistics["failed_snapshots"],
-            statistics["failed_patches"],
-        )
-    )
-    message_lines = message_lines + patched_vms(statistics["patched_vms"])
-    if statistics["failed_patches"]:
-        message_lines = message_lines + message_section(
-            "Failed to patch the following VMs:",
-            Style.RED,
-            statistics["failed_patches"],
-        )
-    if statistics["ssh_failed_vms"]:
-        message_lines = message_lines + message_section(
-            "Failed to connect to the following VMs:",
-            Style.RED,
-            statistics["ssh_failed_vms"],
-        )
-    if statistics["failed_snapshots"]:
-        message_lines = message_lines + message_section(
-            "Failed to create snapshots for the following VMs:",
-            Style.RED,
-            statistics["failed_snapshots"],
-        )
-    if statistics["needs_reboot"]:
-        message_lines = message_lines + message_section(
-            "The following VMs have to be rebooted manually:",
-            Style.RED,
-            statistics["needs_reboot"],
-        )
-    if statistics["manual_patches"]:
-        message_lines = message_lines + message_section(
-            "The following VMs are configured to be manually patched:",
-            Style.YELLOW,
-            statistics["manual_patches"],
-        )
-    if statistics["unsupported"]:
-        message_lines = message_lines + message_section(
-            "The following VMs are unsupported and could not be patched:",
-            Style.RED,
-            statistics["unsupported"],
-        )
+    """Generate a notification message without any styling."""
+    message_lines = [result_header(statistics)]
+    message_lines.extend(format_patched_vms(statistics["patched_vms"]))
+    for stat, header, style in SUMMARY_SECTIONS:
+        if statistics[stat]:
+            message_lines.extend(format_section(header, statistics[stat]))
     return "\n".join(message_lines)
 
 
-def patch_host(host, distro, package_manager, update_command):
-    """Function to patch a host"""
+def print_summary(statistics):
+    """Prints the result summary with ANSI styling"""
+    header = result_header(statistics).strip()
+    if header.endswith("errors"):
+        print(f"\n\n{Style.RED}{header}{Style.NC}\n")
+    else:
+        print(f"\n\n{Style.GREEN}{header}{Style.NC}\n")
+    print("\n\nThe following VMs have been patched:\n")
+    for host, updated_packages in statistics["patched_vms"]:
+        print(f"{Style.BLUE}{host}:{Style.NC} {updated_packages} packages updated")
+    for stat, header, style in SUMMARY_SECTIONS:
+        if statistics[stat]:
+            print_section(header, style, statistics[stat])
+
+
+async def patch_host(ssh, host, distro):
+    """Function to patch a host.
+    Distro detection (if needed), database refresh, upgrade and the
+    reboot check all run as a single fused SSH exec. Returns whether the
+    patch succeeded and whether the host needs a reboot.
+    """
     print(f"Starting patch for {Style.BLUE}{host}{Style.NC}...")
-    if distro == "debian":
-        command = f"sudo {package_manager} update -y"
-        exit_status, stdout, stderr = ssh_command(host, command)
-        if exit_status != 0:
-            print(
-                f"{Style.RED}Error while updating the package database! "
-                f"Skipping {Style.BLUE}{host}{Style.NC}"
-            )
-            update_stats("failed_patches", host)
-            return False
-    command = f"sudo {package_manager} {update_command}"
-    exit_status, stdout, stderr = ssh_command(host, command)
-    if stdout:
-        if convert_to_bool(ENABLE_PATCH_OUTPUT):
-            print(f"Output from {Style.BLUE}{host}{Style.NC}:\n{stdout}")
-        updated_packages = count_updated_packages(stdout, distro)
+    command = build_patch_command(distro)
+    print(
+        f"Executing command on {Style.BLUE}{host}{Style.NC}: "
+        f"{Style.PURPLE}{command}{Style.NC}"
+    )
+    markers = {"reboot_required": False, "distro": distro}
+    async with ssh.create_process(command) as process:
+        updated_packages = await count_updated_packages(
+            stream_lines(extract_markers(process.stdout, markers), host)
+        )
+        stderr = await process.stderr.read()
+        await process.wait()
+    if markers["distro"] == "unsupported":
+        print(
+            f"{Style.RED}Unsupported distro detected! "
+            f"Could not set package manager!{Style.NC}"
+        )
+        update_stats("unsupported", host)
+        return False, False
+    if process.exit_status == 0:
         print(
             f"{Style.GREEN}{updated_packages} packages updated on {Style.BLUE}{host}{Style.NC}"
         )
         update_stats("patched_vms", host, updated_packages)
-        return True
+        return True, markers["reboot_required"]
     if stderr:
         print(f"Errors from {host}:\n{stderr}")
-        update_stats("failed_patches", host)
-        return False
     update_stats("failed_patches", host)
-    return False
+    return False, False
 
 
-def reboot_host(vmid, vm, distro):
-    """Checks if a VM needs a reboot and restarts it"""
-    print(
-        f"Checking if reboot for {Style.BLUE}{vm["hostname"]}{Style.NC} is necessary..."
-    )
-    reboot_required = False
-    if distro == "debian":
-        command = "sudo ls -lah /var/run/reboot-required"
-        exit_status, stdout, stderr = ssh_command(vm["hostname"], command)
-        if exit_status == 0:
-            reboot_required = True
-    elif distro == "redhat":
-        command = "sudo needs-restarting -r"
-        exit_status, stdout, stderr = ssh_command(vm["hostname"], command)
-        if exit_status == 1:
-            reboot_required = True
+async def reboot_host(vmid, vm, reboot_required):
+    """Reboots a VM if the patch reported a pending reboot.
+    The check itself already ran as part of the update command.
+    """
     if reboot_required:
         if vm["reboot"]:
             print(
                 f"{Style.YELLOW}Reboot required on {Style.BLUE}{vm["hostname"]}{Style.NC}. "
                 f"Rebooting now..."
             )
-            reboot_vm(vmid)
+            await asyncio.to_thread(reboot_vm, vmid)
         else:
             update_stats("needs_reboot", vm["hostname"])
     else:
@@ -522,65 +652,94 @@ def reboot_host(vmid, vm, distro):
         )
 
 
-def patch_vm(vm, vmid):
-    """Patch a VM."""
+async def patch_vm(vm, vmid):
+    """Patch a VM.
+    At most MAX_CONCURRENCY VMs are patched at the same time.
+    """
+    async with patch_semaphore:
+        return await patch_vm_inner(vm, vmid)
+
+
+async def patch_vm_inner(vm, vmid):
+    """The actual patch workflow for a single VM"""
     print(f"Waiting for SSH to become available on {vm["hostname"]}...")
-    if ssh_available(vm["hostname"]):
+    ssh = await wait_and_connect(vm["hostname"])
+    if ssh is None:
+        print(
+            f"{Style.RED}SSH not available on {Style.BLUE}{vm["hostname"]}{Style.RED} "
+            f"after {SSH_TIMEOUT} seconds!{Style.NC} Skipping patch."
+        )
+        update_stats("ssh_failed_vms", vm["hostname"])
+        return False
+    try:
         print(
             f"{Style.GREEN}SSH is available on {Style.BLUE}{vm["hostname"]}{Style.NC}. "
             f"Looking for snapshot..."
         )
-        if manage_snapshots(vmid, vm["hostname"]):
+        if await manage_snapshots(vmid, vm["hostname"]):
             print(f"{Style.GREEN}Snapshot successfully created.{Style.NC}")
         else:
             print(
                 f"{Style.RED}Skipping patch for {Style.BLUE}{vm["hostname"]}{Style.RED}!{Style.NC}"
             )
             return False
-        distro, package_manager, update_command = set_update_command(vm["hostname"])
-        if distro is None:
-            print(
-                f"{Style.RED}Skipping patch for {Style.BLUE}{vm["hostname"]}{Style.NC}"
-            )
-            update_stats("unsupported", vm["hostname"])
-            return False
-        if patch_host(vm["hostname"], distro, package_manager, update_command):
-            reboot_host(vmid, vm, distro)
+        patched, reboot_required = await patch_host(ssh, vm["hostname"], vm["distro"])
+        if patched:
+            await reboot_host(vmid, vm, reboot_required)
             return True
         return False
-    print(
-        f"{Style.RED}SSH not available on {Style.BLUE}{vm["hostname"]}{Style.RED} "
-        f"after {SSH_TIMEOUT} seconds!{Style.NC} Skipping patch."
-    )
-    update_stats("ssh_failed_vms", vm["hostname"])
-    return False
+    finally:
+        ssh.close()
 
 
-def main():
-    """Main function to patch all VMs."""
+async def main():
+    """Main function to patch all VMs in parallel."""
     check_requirements()
     vms = get_vms()
-    initially_stopped_vms = []
-    for vmid, vm in vms.items():
-        if vm["status"] == "stopped":
-            start_vm(vmid)
-            initially_stopped_vms.append(vmid)
-        if patch_vm(vm, vmid):
+    initially_stopped_vms = [
+        vmid for vmid, vm in vms.items() if vm["status"] == "stopped"
+    ]
+    if initially_stopped_vms:
+        await asyncio.gather(
+            *(asyncio.to_thread(start_vm, vmid) for vmid in initially_stopped_vms)
+        )
+    tasks = [patch_vm(vm, vmid) for vmid, vm in vms.items()]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for vm, result in zip(vms.values(), results):
+        if result is True:
             print(
                 f"{Style.GREEN}Patching of {Style.BLUE}{vm["hostname"]} "
                 f"{Style.GREEN}complete{Style.NC}."
             )
+        elif isinstance(result, BaseException):
+            # A crashed task would otherwise vanish from the stats and the
+            # notification would report the run as successful
+            print(
+                f"{Style.RED}Patching of {Style.BLUE}{vm["hostname"]} "
+                f"{Style.RED}failed: {result}{Style.NC}"
+            )
+            update_stats("failed_patches", vm["hostname"])
         else:
             print(
                 f"{Style.RED}Patching of {Style.BLUE}{vm["hostname"]} "
                 f"{Style.RED}failed!{Style.NC}"
             )
-    for vmid in initially_stopped_vms:
-        stop_vm(vmid)
-    if convert_to_bool(ENABLE_NOTIFICATION):
+    # Fire off the notification first, so the TLS handshake and the send
+    # overlap with shutting the initially stopped VMs down again
+    notification = None
+    if ENABLE_NOTIFICATION:
         message = generate_notification(stats)
-        send_telegram_message(message)
+        notification = asyncio.create_task(
+            asyncio.to_thread(send_telegram_message, message)
+        )
+    if initially_stopped_vms:
+        await asyncio.gather(
+            *(asyncio.to_thread(stop_vm, vmid) for vmid in initially_stopped_vms)
+        )
+    print_summary(stats)
+    if notification is not None:
+        await notification
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())